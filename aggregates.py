@@ -0,0 +1,85 @@
+# aggregates.py
+# The coverage / per-bucket average / monthly total query shared by
+# transform.py (cached in *_trips_summary) and analysis.py (live queries)
+
+# Output tag (the `grp` column) -> its GROUPING SETS entry
+GROUPING_SETS = {
+    "report_hour":   "(report_hour)",
+    "day_of_week":   "(day_of_week)",
+    "week_of_year":  "(week_of_year)",
+    "month_of_year": "(month_of_year)",
+    "month_total":   "(year, month_of_year)",
+    "overall":       "()",
+}
+BUCKET_SETS = ("report_hour", "day_of_week", "week_of_year", "month_of_year")
+TOTAL_SETS = ("month_total", "overall")
+
+
+# Build the GROUPING SETS query over a transformed source
+def bucket_aggregates_sql(source: str, sets=BUCKET_SETS + TOTAL_SETS, sample: str = "") -> str:
+    """
+    One row per group of each requested set, tagged in `grp`: a bucket column
+    name ('report_hour' is the 1–24 hour computed here), 'month_total' for the
+    (year, month_of_year) set, or 'overall' for the grand total (coverage and
+    row count). Columns: grp, bucket, year, avg_co2, total_co2, min_dt,
+    max_dt, rows. `sample` is an optional USING SAMPLE clause for the scan.
+    """
+    bucket_cols = [c for c in BUCKET_SETS if c in sets]
+    if "month_total" in sets and "month_of_year" not in bucket_cols:
+        bucket_cols.append("month_of_year")
+
+    # GROUPING() may only name grouped columns, so the tags follow the sets
+    whens = []
+    if "month_total" in sets:
+        whens.append("WHEN GROUPING(year) = 0 THEN 'month_total'")
+    whens += [f"WHEN GROUPING({c}) = 0 THEN '{c}'" for c in BUCKET_SETS if c in sets]
+    grp = f"CASE {' '.join(whens)} ELSE 'overall' END" if whens else "'overall'"
+    bucket = f"COALESCE({', '.join(bucket_cols)})::TINYINT" if bucket_cols else "NULL::TINYINT"
+    year = "year" if "month_total" in sets else "NULL::SMALLINT"
+
+    return f"""
+        SELECT
+            {grp} AS grp,
+            {bucket} AS bucket,
+            {year} AS year,
+            AVG(trip_co2_kgs) AS avg_co2,
+            SUM(trip_co2_kgs)::DOUBLE AS total_co2,
+            MIN(pickup_datetime) AS min_dt,
+            MAX(pickup_datetime) AS max_dt,
+            COUNT(*) AS rows
+        FROM (
+            SELECT
+                ((hour_of_day % 24) + 1)::TINYINT AS report_hour,  -- hours reported as 1–24
+                day_of_week,
+                week_of_year,
+                month_of_year,
+                year,
+                trip_co2_kgs,
+                pickup_datetime
+            FROM {source}
+            {sample}
+        )
+        GROUP BY GROUPING SETS ({', '.join(GROUPING_SETS[s] for s in sets)})
+    """
+
+
+# Build the largest-single-trip query over a transformed source
+def largest_trip_sql(source: str) -> str:
+    """
+    One row: top_co2 (the largest trip_co2_kgs) and top, a struct with that
+    trip's trip_distance, pickup_datetime, dropoff_datetime, cab_type and
+    vendor_id (streaming arg_max, no sort).
+    """
+    return f"""
+        SELECT
+            MAX(trip_co2_kgs)::DOUBLE AS top_co2,
+            arg_max({{
+                'trip_distance':    trip_distance,
+                'pickup_datetime':  pickup_datetime,
+                'dropoff_datetime': dropoff_datetime,
+                'cab_type':         cab_type,
+                'vendor_id':        vendor_id
+            }}, trip_co2_kgs) AS top
+        FROM {source}
+        WHERE trip_co2_kgs IS NOT NULL
+    """
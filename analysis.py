@@ -1,24 +1,40 @@
 # analysis.py
 import os
 import duckdb
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from aggregates import BUCKET_SETS, TOTAL_SETS, bucket_aggregates_sql, largest_trip_sql
+from settings import configure_connection
+
 DB_PATH = "emissions.duckdb"
 OUT_DIR = "outputs"
 PLOT_PATH = os.path.join(OUT_DIR, "monthly_co2_totals_2015_2024.png")
 
-DAY_NAMES = {0: "Sun", 1: "Mon", 2: "Tue", 3: "Wed", 4: "Thu", 5: "Fri", 6: "Sat"}
-MONTH_NAMES = {
-    1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May", 6: "Jun",
-    7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct", 11: "Nov", 12: "Dec"
-}
+# Name lookups indexed by bucket value (Sun=0; months are 1-based)
+DAY_NAMES = np.array(["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"])
+MONTH_NAMES = np.array([
+    "", "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
+])
 
 CAB_TABLES = {
     "YELLOW": "yellow_trips_transformed_all",
     "GREEN":  "green_trips_transformed_all",
 }
 
+# Aggregates cached by transform.py (same rows as bucket_aggregates + largest trip)
+SUMMARY_TABLES = {
+    "YELLOW": "yellow_trips_summary",
+    "GREEN":  "green_trips_summary",
+}
+
+# FAST_ANALYZE=1 estimates the per-bucket averages from a fixed-size sample when
+# no summary table exists (dev iteration); coverage and totals stay exact
+FAST_ANALYZE = os.environ.get("FAST_ANALYZE") == "1"
+FAST_SAMPLE_ROWS = 1_000_000
+
 # Check if a table exists in DuckDB
 def table_exists(con, name: str) -> bool:
     row = con.execute(
@@ -33,62 +49,85 @@ def label_header(title: str):
     print(title)
     print("=" * len(title))
 
-# Get min/max pickup_datetime and row count
-def get_date_range(con, table):
-    q = f"""
-        SELECT
-            MIN(pickup_datetime) AS min_dt,
-            MAX(pickup_datetime) AS max_dt,
-            COUNT(*) AS rows
-        FROM {table}
-    """
-    return con.execute(q).fetchdf().iloc[0]
-
-# Get the highest CO₂ single trip
-def get_max_trip(con, table):
-    q = f"""
-        SELECT
-            trip_co2_kgs,
-            trip_distance,
-            pickup_datetime,
-            dropoff_datetime,
-            cab_type,
-            vendor_id
-        FROM {table}
-        WHERE trip_co2_kgs IS NOT NULL
-        ORDER BY trip_co2_kgs DESC
-        LIMIT 1;
+# Coverage, per-bucket averages and monthly totals in a single scan
+def bucket_aggregates(con, table, sample_rows: int | None = None, label: str = ""):
     """
-    return con.execute(q).fetchdf()
-
-# Average CO₂ grouped by a bucket column
-def avg_by_bucket(con, table, bucket_col):
-    q = f"""
-        SELECT {bucket_col} AS bucket, AVG(trip_co2_kgs) AS avg_co2
-        FROM {table}
-        WHERE trip_co2_kgs IS NOT NULL AND {bucket_col} IS NOT NULL
-        GROUP BY 1
-        ORDER BY 1;
+    One GROUPING SETS query over the table (built by aggregates.py, which
+    transform.py also uses to cache the same rows in *_trips_summary). Each
+    output row is tagged in `grp` with the set it belongs to: a bucket column
+    name ('report_hour' is the 1–24 hour computed in SQL), 'month_total' for
+    the (year, month_of_year) set, or 'overall' for the grand total (coverage
+    and row count).
+
+    With sample_rows, only the four bucket-average sets are computed from a
+    repeatable reservoir sample of that many rows (uniform over rows, so the
+    table's pickup-time ordering doesn't bias it); coverage and monthly totals
+    still come from the full table. If the sample misses any bucket the data
+    covers, the averages are recomputed from the full table with a warning.
     """
-    return con.execute(q).fetchdf()
+    if not sample_rows:
+        return con.execute(bucket_aggregates_sql(table)).fetchdf()
+    sample = f"USING SAMPLE reservoir({sample_rows} ROWS) REPEATABLE (42)"
+    totals = con.execute(bucket_aggregates_sql(table, TOTAL_SETS)).fetchdf()
+    averages = con.execute(bucket_aggregates_sql(table, BUCKET_SETS, sample)).fetchdf()
+    short = incomplete_buckets(totals, averages)
+    if short:
+        print(f"[WARN] {label}: {sample_rows:,}-row sample missed some {', '.join(short)} buckets; "
+              "using the full table")
+        averages = con.execute(bucket_aggregates_sql(table, BUCKET_SETS)).fetchdf()
+    else:
+        print(f"[{label}] FAST_ANALYZE: bucket averages are estimated from a {sample_rows:,}-row sample")
+    return pd.concat([totals, averages], ignore_index=True)
+
+# Bucket sets whose sampled rows don't cover every bucket the data spans
+def incomplete_buckets(totals, averages):
+    # Calendar days of every (year, month) present in the full data
+    months = totals[(totals["grp"] == "month_total") & totals["year"].notna()]
+    starts = ((months["year"].to_numpy(dtype=int) - 1970) * 12
+              + months["bucket"].to_numpy(dtype=int) - 1).astype("datetime64[M]")
+    days = np.concatenate([np.arange(m, m + 1, dtype="datetime64[D]") for m in starts]) if starts.size \
+        else np.array([], dtype="datetime64[D]")
+    days = pd.DatetimeIndex(days)
+    expected = {
+        "report_hour": 24 if days.size else 0,
+        "day_of_week": days.dayofweek.nunique(),
+        "week_of_year": days.isocalendar().week.nunique(),
+        "month_of_year": days.month.nunique(),
+    }
+    got = averages[averages["bucket"].notna()].groupby("grp")["bucket"].nunique()
+    return [grp for grp, n in expected.items() if got.get(grp, 0) < n]
+
+# Get min/max pickup_datetime and row count
+def get_date_range(aggs):
+    return aggs[aggs["grp"] == "overall"].iloc[0]
+
+# Average CO₂ per trip for one bucket column
+def avg_by_bucket(aggs, bucket_col):
+    sel = aggs[(aggs["grp"] == bucket_col) & aggs["bucket"].notna() & aggs["avg_co2"].notna()]
+    return sel[["bucket", "avg_co2"]].sort_values("bucket").reset_index(drop=True)
 
 # Monthly totals across all 10 years
-def monthly_totals_full(con, table):
-    q = f"""
-        SELECT
-            date_trunc('month', pickup_datetime) AS ym,
-            EXTRACT('year' FROM pickup_datetime)::INT   AS year,
-            EXTRACT('month' FROM pickup_datetime)::INT  AS month,
-            SUM(trip_co2_kgs) AS total_co2
-        FROM {table}
-        WHERE trip_co2_kgs IS NOT NULL
-        GROUP BY 1, 2, 3
-        ORDER BY ym
-    """
-    df = con.execute(q).fetchdf()
+def monthly_totals_full(aggs):
+    sel = aggs[(aggs["grp"] == "month_total") & aggs["year"].notna() & aggs["bucket"].notna()
+               & aggs["total_co2"].notna()]
+    df = pd.DataFrame({
+        "year": sel["year"].astype(int),
+        "month": sel["bucket"].astype(int),
+        "total_co2": sel["total_co2"],
+    }).sort_values(["year", "month"]).reset_index(drop=True)
+    # Month starts via datetime64[M] arithmetic rather than pandas date parsing
+    months = (df["year"].to_numpy() - 1970) * 12 + (df["month"].to_numpy() - 1)
+    df["ym"] = months.astype("datetime64[M]").astype("datetime64[ns]")
     df["label"] = df["ym"].dt.strftime("%Y-%m")
     return df
 
+# Get the highest CO₂ single trip (streaming arg_max, no sort)
+def get_max_trip(con, table):
+    co2, top = con.execute(largest_trip_sql(table)).fetchone()
+    if co2 is None:
+        return None
+    return {"trip_co2_kgs": co2, **top}
+
 # Find heaviest and lightest total-CO₂ months
 def heaviest_lightest_month_totals(df):
     if df.empty:
@@ -98,47 +137,58 @@ def heaviest_lightest_month_totals(df):
     return heavy, light
 
 # Print summary stats for a cab table
-def analyze_cab(con, table: str, label: str):
+def analyze_cab(con, table: str, label: str, summary: str | None = None):
     if not table_exists(con, table):
         print(f"[WARN] Missing table '{table}'. Skipping {label}.")
         return None
 
     label_header(f"{label} — ANALYSIS (2015–2024)")
 
+    # Coverage, bucket averages and monthly totals come from the cached summary
+    # when transform.py built one (exact, and faster than any sample), otherwise
+    # from a scan of the table
+    cached = summary is not None and table_exists(con, summary)
+    if cached:
+        aggs = con.execute(f"SELECT * FROM {summary};").fetchdf()
+    else:
+        aggs = bucket_aggregates(con, table, FAST_SAMPLE_ROWS if FAST_ANALYZE else None, label)
+
     # Coverage info
-    rng = get_date_range(con, table)
+    rng = get_date_range(aggs)
     print(f"[{label}] Coverage: {pd.to_datetime(rng['min_dt'])} → {pd.to_datetime(rng['max_dt'])}  ({int(rng['rows']):,} rows)")
 
     # 1) Largest carbon-producing trip (single across all years)
-    top = get_max_trip(con, table)
-    if not top.empty:
-        r = top.iloc[0]
+    if cached:
+        top = get_date_range(aggs)
+        r = None if pd.isna(top["top_co2"]) else {"trip_co2_kgs": top["top_co2"], **top["top"]}
+    else:
+        r = get_max_trip(con, table)
+    if r is not None:
         print(f"[{label}] Largest single-trip CO₂: {r['trip_co2_kgs']:.3f} kg")
         print(f"  pickup:        {r['pickup_datetime']}")
         print(f"  dropoff:       {r['dropoff_datetime']}")
-        print(f"  distance:      {r['trip_distance']} miles")
+        print(f"  distance:      {r['trip_distance']:.2f} miles")
         print(f"  vendor_id:     {r['vendor_id']}")
 
     # 2) Hour of day (report 1–24). Average CO₂ per trip by hour across all years.
-    hour_df = avg_by_bucket(con, table, "hour_of_day")
+    hour_df = avg_by_bucket(aggs, "report_hour")
     if not hour_df.empty:
-        hour_df["report_hour"] = ((hour_df["bucket"] % 24) + 1).astype(int)
         light_h = hour_df.loc[hour_df["avg_co2"].idxmin()]
         heavy_h = hour_df.loc[hour_df["avg_co2"].idxmax()]
-        print(f"[{label}] Lightest avg CO₂ hour (1–24): {int(light_h['report_hour'])} — {light_h['avg_co2']:.3f} kg/trip")
-        print(f"[{label}] Heaviest avg CO₂ hour (1–24): {int(heavy_h['report_hour'])} — {heavy_h['avg_co2']:.3f} kg/trip")
+        print(f"[{label}] Lightest avg CO₂ hour (1–24): {int(light_h['bucket'])} — {light_h['avg_co2']:.3f} kg/trip")
+        print(f"[{label}] Heaviest avg CO₂ hour (1–24): {int(heavy_h['bucket'])} — {heavy_h['avg_co2']:.3f} kg/trip")
 
     # 3) Day of week (Sun–Sat) — average CO₂ per trip across all years
-    dow_df = avg_by_bucket(con, table, "day_of_week")
+    dow_df = avg_by_bucket(aggs, "day_of_week")
     if not dow_df.empty:
-        dow_df["name"] = dow_df["bucket"].astype(int).map(DAY_NAMES)
+        dow_df["name"] = DAY_NAMES[dow_df["bucket"].to_numpy(dtype=np.int8)]
         light_d = dow_df.loc[dow_df["avg_co2"].idxmin()]
         heavy_d = dow_df.loc[dow_df["avg_co2"].idxmax()]
         print(f"[{label}] Lightest avg CO₂ day: {light_d['name']} — {light_d['avg_co2']:.3f} kg/trip")
         print(f"[{label}] Heaviest avg CO₂ day: {heavy_d['name']} — {heavy_d['avg_co2']:.3f} kg/trip")
 
     # 4) Week of year (1–52/53) — average CO₂ per trip across all years
-    wk_df = avg_by_bucket(con, table, "week_of_year")
+    wk_df = avg_by_bucket(aggs, "week_of_year")
     if not wk_df.empty:
         # DuckDB ISO week can be 1–53
         light_w = wk_df.loc[wk_df["avg_co2"].idxmin()]
@@ -147,16 +197,16 @@ def analyze_cab(con, table: str, label: str):
         print(f"[{label}] Heaviest avg CO₂ week: {int(heavy_w['bucket'])} — {heavy_w['avg_co2']:.3f} kg/trip")
 
     # 5) Month of year (Jan–Dec) — average CO₂ per trip across all years
-    mo_df = avg_by_bucket(con, table, "month_of_year")
+    mo_df = avg_by_bucket(aggs, "month_of_year")
     if not mo_df.empty:
-        mo_df["name"] = mo_df["bucket"].astype(int).map(MONTH_NAMES)
+        mo_df["name"] = MONTH_NAMES[mo_df["bucket"].to_numpy(dtype=np.int8)]
         light_m = mo_df.loc[mo_df["avg_co2"].idxmin()]
         heavy_m = mo_df.loc[mo_df["avg_co2"].idxmax()]
         print(f"[{label}] Lightest avg CO₂ month: {light_m['name']} — {light_m['avg_co2']:.3f} kg/trip")
         print(f"[{label}] Heaviest avg CO₂ month: {heavy_m['name']} — {heavy_m['avg_co2']:.3f} kg/trip")
 
     # 6) Most/least carbon-heavy MONTH (by TOTALS, not averages), across the full 10 years
-    mt = monthly_totals_full(con, table)
+    mt = monthly_totals_full(aggs)
     heavy, light = heaviest_lightest_month_totals(mt)
     if heavy is not None:
         print(f"[{label}] Heaviest month total: {heavy['label']} — {heavy['total_co2']:.3f} kg")
@@ -178,29 +228,32 @@ def plot_monthly_10yr(y_df: pd.DataFrame | None, g_df: pd.DataFrame | None):
         print("[Plot] No data to plot.")
         return
 
-    # Filter to 2015–2024 and sort by month-year
-    def prep(df: pd.DataFrame) -> pd.DataFrame:
+    # Filter to 2015–2024 and sort by month-year, as plain (x, y) NumPy arrays
+    def prep(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
         if df is None or df.empty:
-            return pd.DataFrame(columns=["ym", "total_co2"])  # empty
-        sel = df[(df["year"] >= 2015) & (df["year"] <= 2024)].copy()
-        sel = sel.sort_values("ym")
-        return sel
+            return np.array([], dtype="datetime64[ns]"), np.array([])  # empty
+        year = df["year"].to_numpy()
+        keep = (year >= 2015) & (year <= 2024)
+        ym, total = df["ym"].to_numpy()[keep], df["total_co2"].to_numpy()[keep]
+        order = np.argsort(ym, kind="stable")
+        return ym[order], total[order]
 
     y_m = prep(y_df)
     g_m = prep(g_df)
 
-    if y_m.empty and g_m.empty:
+    if not y_m[0].size and not g_m[0].size:
         print("[Plot] No monthly data in range 2015–2024 to plot.")
         return
 
     os.makedirs(OUT_DIR, exist_ok=True)
     out_path = PLOT_PATH
 
-    plt.figure(figsize=(14, 6))
-    if not y_m.empty:
-        plt.plot(y_m["ym"], y_m["total_co2"], marker="o", label="YELLOW", linewidth=1.8, color="yellow")
-    if not g_m.empty:
-        plt.plot(g_m["ym"], g_m["total_co2"], marker="s", label="GREEN", linewidth=1.8, color="green")
+    fig = plt.figure(figsize=(14, 6))
+    # Hand matplotlib plain NumPy arrays (datetime64/float64) rather than Series
+    if y_m[0].size:
+        plt.plot(*y_m, marker="o", label="YELLOW", linewidth=1.8, color="yellow")
+    if g_m[0].size:
+        plt.plot(*g_m, marker="s", label="GREEN", linewidth=1.8, color="green")
 
     # Format x-axis as monthly ticks across 10 years
     ax = plt.gca()
@@ -214,6 +267,7 @@ def plot_monthly_10yr(y_df: pd.DataFrame | None, g_df: pd.DataFrame | None):
     plt.grid(True, which='both', axis='both', alpha=0.3)
     plt.tight_layout()
     plt.savefig(out_path, dpi=150)
+    plt.close(fig)  # release the figure and its canvas once saved
     print(f"[Plot] Saved monthly CO₂ totals to: {out_path}")
 
 
@@ -229,36 +283,35 @@ def plot_yearly_10yr(y_df: pd.DataFrame | None, g_df: pd.DataFrame | None):
         print("[Plot] No data to plot for yearly totals.")
         return
 
-    # Aggregate to yearly totals and restrict to 2015–2024
-    def to_yearly(df: pd.DataFrame) -> pd.DataFrame:
+    # Aggregate to yearly totals and restrict to 2015–2024, as (years, totals) arrays
+    def to_yearly(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
         if df is None or df.empty:
-            return pd.DataFrame(columns=["year", "total_co2"])  # empty
-        yr = (
-            df[(df["year"] >= 2015) & (df["year"] <= 2024)]
-            .groupby("year", as_index=False)["total_co2"].sum()
-            .sort_values("year")
-        )
-        return yr
+            return np.array([], dtype=int), np.array([])  # empty
+        year = df["year"].to_numpy()
+        keep = (year >= 2015) & (year <= 2024)
+        years, idx = np.unique(year[keep], return_inverse=True)  # sorted
+        totals = np.bincount(idx, weights=df["total_co2"].to_numpy()[keep], minlength=years.size)
+        return years, totals
 
     y_year = to_yearly(y_df)
     g_year = to_yearly(g_df)
 
-    if y_year.empty and g_year.empty:
+    if not y_year[0].size and not g_year[0].size:
         print("[Plot] No yearly data in range 2015–2024 to plot.")
         return
 
     os.makedirs(OUT_DIR, exist_ok=True)
     out_path = os.path.join(OUT_DIR, "yearly_co2_totals_2015_2024.png")
 
-    plt.figure(figsize=(12, 6))
-    if not y_year.empty:
-        plt.plot(y_year["year"], y_year["total_co2"], marker="o", label="YELLOW", linewidth=2, color="yellow")
-    if not g_year.empty:
-        plt.plot(g_year["year"], g_year["total_co2"], marker="s", label="GREEN", linewidth=2, color="green")
+    fig = plt.figure(figsize=(12, 6))
+    if y_year[0].size:
+        plt.plot(*y_year, marker="o", label="YELLOW", linewidth=2, color="yellow")
+    if g_year[0].size:
+        plt.plot(*g_year, marker="s", label="GREEN", linewidth=2, color="green")
 
     # X-axis ticks as whole years in range if present
-    all_years = sorted(set(y_year.get("year", pd.Series(dtype=int))) | set(g_year.get("year", pd.Series(dtype=int))))
-    if all_years:
+    all_years = np.union1d(y_year[0], g_year[0]).astype(int)
+    if all_years.size:
         plt.xticks(all_years, [str(y) for y in all_years])
     plt.xlabel("Year")
     plt.ylabel("CO₂ (kg)")
@@ -267,11 +320,13 @@ def plot_yearly_10yr(y_df: pd.DataFrame | None, g_df: pd.DataFrame | None):
     plt.grid(True, alpha=0.3)
     plt.tight_layout()
     plt.savefig(out_path, dpi=150)
+    plt.close(fig)
     print(f"[Plot] Saved yearly CO₂ totals to: {out_path}")
 
 # Orchestrate analysis and plotting
 def main():
     con = duckdb.connect(DB_PATH, read_only=True)
+    configure_connection(con)
 
     # Prefer union tables created by transform.py
     missing = [t for t in CAB_TABLES.values() if not table_exists(con, t)]
@@ -280,8 +335,15 @@ def main():
         print("       Re-run transform.py so it creates *_trips_transformed_all union tables.")
         # You could add a fallback to stitch per-year tables, but directions say to build off transform.py.
 
-    y_df = analyze_cab(con, CAB_TABLES["YELLOW"], "YELLOW")
-    g_df = analyze_cab(con, CAB_TABLES["GREEN"],  "GREEN")
+    # Live queries scan transform.py's Parquet export when it registered one
+    # (DuckDB decodes only the columns each query touches); otherwise the tables
+    sources = {
+        label: view if table_exists(con, view := f"{label.lower()}_trips_transformed_parquet") else table
+        for label, table in CAB_TABLES.items()
+    }
+
+    y_df = analyze_cab(con, sources["YELLOW"], "YELLOW", SUMMARY_TABLES["YELLOW"])
+    g_df = analyze_cab(con, sources["GREEN"],  "GREEN",  SUMMARY_TABLES["GREEN"])
 
     if (y_df is None or y_df.empty) and (g_df is None or g_df.empty):
         print("\nNo transformed union tables found. Run transform.py first.")
@@ -1,7 +1,12 @@
 import duckdb
 import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
+from settings import configure_connection
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -19,23 +24,45 @@ MAX_TRIP_MILES = 100.0
 YEARS = range(2015, 2025)  # 2015..2024 inclusive
 CABS = ("yellow", "green")
 
+# Yearly tables cleaned concurrently; each query is already multi-threaded,
+# so a few workers is enough to overlap them without multiplying peak memory
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Partitioned Parquet copy of all cleaned trips (cab_type=*/year=*/*.parquet)
+# for consumers outside DuckDB; opt-in with CLEAN_EXPORT_PARQUET=1, since the
+# pipeline itself reads the *_clean tables
+CLEAN_PARQUET_DIR = "clean"
+CLEAN_EXPORT_PARQUET = os.environ.get("CLEAN_EXPORT_PARQUET") == "1"
+
+
+# Shared DuckDB resources, plus clean-specific settings
+def configure_clean_connection(con):
+    configure_connection(con)
+    # Row order is irrelevant here (dedupe keeps an arbitrary copy), so let
+    # DuckDB skip order-preserving materialization
+    con.execute("SET preserve_insertion_order = false;")
 
-# Check if a table exists in DuckDB
-def table_exists(con, name: str) -> bool:
+
+# Drop a table or view by name, whichever currently exists
+def drop_relation(con, name: str):
     row = con.execute(
-        "SELECT 1 FROM information_schema.tables WHERE table_name = ?;",
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?;",
         [name]
     ).fetchone()
-    return row is not None
+    if row is not None:
+        kind = "VIEW" if row[0] == "VIEW" else "TABLE"
+        con.execute(f"DROP {kind} {name};")
 
 
 # Return (src,dst) pairs for all existing per-year cab tables
 def discover_src_tables(con):
+    # One catalog query, not one probe per name
+    existing = {r[0] for r in con.execute("SELECT table_name FROM information_schema.tables;").fetchall()}
     pairs = []
     for cab in CABS:
         for y in YEARS:
             src = f"{cab}_trips_{y}"
-            if table_exists(con, src):
+            if src in existing:
                 dst = f"{src}_clean"
                 pairs.append((src, dst))
             else:
@@ -48,73 +75,58 @@ def clean_one(con, src: str, dst: str):
     logger.info("Cleaning %s -> %s", src, dst)
     con.execute(f"DROP TABLE IF EXISTS {dst};")
 
+    # Filter and dedupe in one SELECT; the duration predicate is evaluated
+    # inline so no extra computed column is carried into the dedupe
     sql = f"""
-    WITH base AS (
-        SELECT
-            cab_type,
-            vendor_id,
-            pickup_datetime,
-            dropoff_datetime,
-            passenger_count,
-            trip_distance,
-            date_diff('second', pickup_datetime, dropoff_datetime) AS duration_seconds
-        FROM {src}
-    ),
-    filtered AS (
-        SELECT
-            cab_type,
-            vendor_id,
-            pickup_datetime,
-            dropoff_datetime,
-            passenger_count,
-            trip_distance
-        FROM base
-        WHERE
-            (passenger_count IS NULL OR passenger_count <> 0)
-            AND trip_distance > 0
-            AND trip_distance <= {MAX_TRIP_MILES}
-            AND duration_seconds <= {MAX_TRIP_SECONDS}
-    )
-    SELECT DISTINCT
+    SELECT
         cab_type,
         vendor_id,
         pickup_datetime,
         dropoff_datetime,
         passenger_count,
-        trip_distance
-    FROM filtered
+        trip_distance::FLOAT AS trip_distance  -- 0–100 mi, FP32 is ample
+    FROM {src}
+    WHERE
+        (passenger_count IS NULL OR passenger_count <> 0)
+        AND trip_distance > 0
+        AND trip_distance <= {MAX_TRIP_MILES}
+        AND date_diff('second', pickup_datetime, dropoff_datetime) <= {MAX_TRIP_SECONDS}
+    -- Drop exact duplicates. The key leads with the trip's natural identity
+    -- (cab, vendor, pickup second) and folds the remaining columns into one
+    -- hash, so only rows identical in every column collapse
+    QUALIFY row_number() OVER (
+        PARTITION BY
+            cab_type,
+            vendor_id,
+            pickup_datetime,
+            hash(dropoff_datetime, passenger_count, trip_distance)
+    ) = 1
     """
     con.execute(f"CREATE TABLE {dst} AS {sql};")
 
 
 # Verify the cleaned table meets constraints
 def verify_clean(con, table: str):
-    total = con.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
-    distinct = con.execute(f"SELECT COUNT(*) FROM (SELECT DISTINCT * FROM {table});").fetchone()[0]
-    dupes = total - distinct
-
-    zero_pass = con.execute(
-        f"SELECT COUNT(*) FROM {table} WHERE passenger_count = 0;"
-    ).fetchone()[0]
-
-    zero_miles = con.execute(
-        f"SELECT COUNT(*) FROM {table} WHERE trip_distance = 0;"
-    ).fetchone()[0]
-
-    over_100 = con.execute(
-        f"SELECT COUNT(*) FROM {table} WHERE trip_distance > {MAX_TRIP_MILES};"
-    ).fetchone()[0]
-
-    over_day = con.execute(
+    # All counters in one scan of the cleaned table
+    total, dupes, zero_pass, zero_miles, over_100, over_day = con.execute(
         f"""
-        SELECT COUNT(*) FROM (
-            SELECT date_diff('second', pickup_datetime, dropoff_datetime) AS s
-            FROM {table}
-        ) WHERE s > {MAX_TRIP_SECONDS};
-        """
-    ).fetchone()[0]
-
-    print(dedent(f"""
+        SELECT
+            COUNT(*) AS total,
+            COUNT(*) - COUNT(DISTINCT (
+                cab_type, vendor_id, pickup_datetime, dropoff_datetime, passenger_count, trip_distance
+            )) AS dupes,
+            COUNT(*) FILTER (WHERE passenger_count = 0) AS zero_pass,
+            COUNT(*) FILTER (WHERE trip_distance = 0) AS zero_miles,
+            COUNT(*) FILTER (WHERE trip_distance > ?) AS over_100,
+            COUNT(*) FILTER (
+                WHERE date_diff('second', pickup_datetime, dropoff_datetime) > ?
+            ) AS over_day
+        FROM {table};
+        """,
+        [MAX_TRIP_MILES, MAX_TRIP_SECONDS]
+    ).fetchone()
+
+    return dedent(f"""
         === VERIFY: {table} ===
           Rows:                 {total:,}
           Duplicates:           {dupes}
@@ -122,61 +134,111 @@ def verify_clean(con, table: str):
           0 miles:              {zero_miles}
           >100 miles:           {over_100}
           >1 day duration:      {over_day}
-    """).rstrip())
+    """).rstrip()
 
 
-# Print row counts before/after cleaning
+# Row counts before/after cleaning
 def summarize_before_after(con, src: str, dst: str):
-    raw = con.execute(f"SELECT COUNT(*) FROM {src};").fetchone()[0]
-    clean = con.execute(f"SELECT COUNT(*) FROM {dst};").fetchone()[0]
-    print(f"[{src} -> {dst}] Raw: {raw:,}  |  Clean: {clean:,}  |  Removed: {raw - clean:,}")
+    raw, clean = con.execute(
+        "SELECT (SELECT COUNT(*) FROM query_table(?)), (SELECT COUNT(*) FROM query_table(?));",
+        [src, dst]
+    ).fetchone()
+    return f"[{src} -> {dst}] Raw: {raw:,}  |  Clean: {clean:,}  |  Removed: {raw - clean:,}"
 
 
-# Build union tables across all cleaned yearly tables
+# Clean, summarize and verify one pair in a single transaction on its own cursor
+def process_pair(con, src: str, dst: str):
+    cur = con.cursor()
+    try:
+        cur.begin()
+        clean_one(cur, src, dst)
+        summary = summarize_before_after(cur, src, dst)
+        report = verify_clean(cur, dst)
+        cur.commit()
+    except Exception:
+        cur.rollback()
+        raise
+    finally:
+        cur.close()
+    # Returned rather than printed so reports from parallel workers don't interleave
+    return summary + "\n" + report
+
+
+# Build union views across all cleaned yearly tables
 def build_unions(con, cleaned_pairs):
     # Per-cab collections
     yellow_clean = [dst for (src, dst) in cleaned_pairs if src.startswith("yellow_")]
     green_clean  = [dst for (src, dst) in cleaned_pairs if src.startswith("green_")]
 
-    # Helper to create a union table
-    def make_union_table(name: str, tables: list[str]):
-        con.execute(f"DROP TABLE IF EXISTS {name};")
+    # Helper to create a union view (no data is copied; scans hit the yearly tables)
+    def make_union_view(name: str, tables: list[str]):
+        drop_relation(con, name)  # may be a table left by an older run
         if not tables:
             logger.info("No tables to union for %s", name)
-            return
+            return False
         union_sql = " UNION ALL ".join([f"SELECT * FROM {t}" for t in tables])
-        con.execute(f"CREATE TABLE {name} AS {union_sql};")
+        con.execute(f"CREATE VIEW {name} AS {union_sql};")
         cnt = con.execute(f"SELECT COUNT(*) FROM {name};").fetchone()[0]
         # pre-format the count with commas for logging
         logger.info("Created %s with %s rows", name, f"{cnt:,}")
         print(f"[UNION] {name}: {cnt:,} rows")
-
-    make_union_table("yellow_trips_clean_all", yellow_clean)
-    make_union_table("green_trips_clean_all", green_clean)
-    make_union_table("all_trips_clean_2015_2024", yellow_clean + green_clean)
+        return True
+
+    # The combined view stacks the per-cab views rather than every yearly table
+    per_cab = [
+        name
+        for name, tables in (("yellow_trips_clean_all", yellow_clean),
+                             ("green_trips_clean_all", green_clean))
+        if make_union_view(name, tables)
+    ]
+    make_union_view("all_trips_clean_2015_2024", per_cab)
+
+
+# Export all cleaned trips to Parquet partitioned by cab and year
+def export_clean_parquet(con, source: str = "all_trips_clean_2015_2024"):
+    con.execute(f"""
+        COPY (
+            SELECT *, EXTRACT('year' FROM pickup_datetime)::SMALLINT AS year
+            FROM {source}
+        ) TO '{CLEAN_PARQUET_DIR}'
+        (FORMAT PARQUET, PARTITION_BY (cab_type, year), COMPRESSION ZSTD, OVERWRITE);
+    """)
+    logger.info("Exported %s to %s/", source, CLEAN_PARQUET_DIR)
+    print(f"[PARQUET] {source} -> {CLEAN_PARQUET_DIR}/cab_type=*/year=*/")
 
 
 # Orchestrate cleaning and union building
 def main():
     try:
         con = duckdb.connect(DB_PATH, read_only=False)
+        configure_clean_connection(con)
         logger.info("Connected to DuckDB")
 
         # Discover all source tables that actually exist
-        cleaned_pairs = []
-        for src, dst in discover_src_tables(con):
-            clean_one(con, src, dst)
-            summarize_before_after(con, src, dst)
-            verify_clean(con, dst)
-            cleaned_pairs.append((src, dst))
+        cleaned_pairs = discover_src_tables(con)
+
+        # An export will be rewritten at the end; drop the old one first so a
+        # failed run can't leave files that disagree with the *_clean tables
+        if CLEAN_EXPORT_PARQUET and cleaned_pairs:
+            shutil.rmtree(CLEAN_PARQUET_DIR, ignore_errors=True)
+
+        # Clean years in parallel
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            reports = pool.map(lambda pair: process_pair(con, *pair), cleaned_pairs)
+            for report in reports:
+                print(report)
 
         if not cleaned_pairs:
             print("No source tables found. Run load.py first.")
             return
 
-        # Build consolidated union tables for convenience
+        # Build consolidated union views for convenience
         build_unions(con, cleaned_pairs)
 
+        # Optional year-pruneable, compressed copy for file-based consumers
+        if CLEAN_EXPORT_PARQUET:
+            export_clean_parquet(con)
+
         # Final summary
         made = ", ".join(dst for _, dst in cleaned_pairs)
         print("\nCleaning complete.")
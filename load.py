@@ -1,7 +1,11 @@
 import duckdb
 import os
 import logging
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import DUCKDB_THREADS, configure_connection
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,18 +17,47 @@ logger = logging.getLogger(__name__)
 DB_PATH = 'emissions.duckdb'
 YEARS = range(2015, 2025)  # 2015..2024 inclusive
 MONTHS = range(1, 13)
-RATE_LIMIT_SECONDS = 15  # to try
+CABS = ('yellow', 'green')
 
-def load_year_cab(con, year: int, cab: str):
-    """
-    Create (drop+create) a table for the given year & cab and load all 12 months.
-    cab ∈ {'yellow','green'}
-    """
-    assert cab in ('yellow', 'green')
-    table = f"{cab}_trips_{year}"
-    logger.info("Loading %s", table)
+# Only wait when the CDN asks: httpfs retries transient errors with backoff, and a
+# 429 that survives those is retried here honoring Retry-After
+THROTTLE_RETRIES = 5
+THROTTLE_DEFAULT_WAIT_SECONDS = 30
+
+# Months already ingested are tracked here; RELOAD=1 clears it and refetches everything
+LEDGER = "_loaded_months"
+RELOAD = os.environ.get("RELOAD") == "1"
+
+# Explicit per-year table schema (tables are created once, then appended to)
+TRIP_SCHEMA = """
+    cab_type         VARCHAR,
+    vendor_id        INTEGER,
+    pickup_datetime  TIMESTAMP,
+    dropoff_datetime TIMESTAMP,
+    passenger_count  UTINYINT,  -- 0..255 seats; TRY_CAST nulls out garbage values
+    trip_distance    FLOAT      -- miles, FP32 is ample
+"""
+
+# 2x cores: the two concurrent cab loads mostly wait on the network
+LOAD_THREADS = 2 * DUCKDB_THREADS
+
+# Run a statement, backing off only when the server throttles us (HTTP 429)
+def execute_throttled(con, sql: str, params=None):
+    for attempt in range(1, THROTTLE_RETRIES + 1):
+        try:
+            return con.execute(sql, params)
+        except duckdb.HTTPException as e:
+            if getattr(e, "status_code", None) != 429 or attempt == THROTTLE_RETRIES:
+                raise
+            headers = getattr(e, "headers", None) or {}
+            retry_after = headers.get("Retry-After", "")
+            wait = int(retry_after) if retry_after.isdigit() else THROTTLE_DEFAULT_WAIT_SECONDS
+            logger.warning("HTTP 429 (attempt %d/%d), retrying in %ss", attempt, THROTTLE_RETRIES, wait)
+            time.sleep(wait)
 
-    # Choose field names & URL patterns
+# Field names & URL pattern for a cab type
+def cab_source(cab: str):
+    assert cab in ('yellow', 'green')
     if cab == 'yellow':
         url_tpl = "https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year}-{month:02d}.parquet"
         vendor_col = "VendorID"
@@ -35,49 +68,161 @@ def load_year_cab(con, year: int, cab: str):
         vendor_col = "VendorID"
         pu_col = "lpep_pickup_datetime"
         do_col = "lpep_dropoff_datetime"
+    return url_tpl, vendor_col, pu_col, do_col
+
+# Record of every (cab, year, month) file already ingested, with its row count
+def ensure_ledger(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER} (
+            cab       VARCHAR,
+            year      INTEGER,
+            month     INTEGER,
+            rows      BIGINT,
+            loaded_at TIMESTAMP,
+            PRIMARY KEY (cab, year, month)
+        );
+    """)
+
+def load_cab(con, cab: str):
+    """
+    Incrementally load a cab: only monthly files missing from the ledger are
+    fetched (one multi-file read_parquet per year, each committed with its
+    ledger rows) and appended to the per-year tables, so a rerun after a
+    failure only pays for what is missing. Set
+    RELOAD=1 to forget the ledger and refetch everything. Returns the total
+    row count across all years and the per-year summary text (returned, not
+    printed, so concurrent cabs don't interleave their output).
+    cab ∈ {'yellow','green'}
+    """
+    staging = f"{cab}_trips_all"
+
+    done = set(con.execute(f"SELECT year, month FROM {LEDGER} WHERE cab = ?;", [cab]).fetchall())
+    if RELOAD or not done:
+        # Start over; with no ledger rows any existing tables predate the ledger
+        con.execute(f"DELETE FROM {LEDGER} WHERE cab = ?;", [cab])
+        for y in YEARS:
+            con.execute(f"DROP TABLE IF EXISTS {cab}_trips_{y};")
+        done = set()
 
-    # Drop then create from first month, append the rest
-    con.execute(f"DROP TABLE IF EXISTS {table};")
-
-    first_done = False
-    for m in MONTHS:
-        url = url_tpl.format(year=year, month=m)
-
-        if not first_done:
-            con.execute(f"""
-                CREATE TABLE {table} AS
-                SELECT
-                    '{cab}' AS cab_type,
-                    {vendor_col} AS vendor_id,
-                    {pu_col}   AS pickup_datetime,
-                    {do_col}   AS dropoff_datetime,
-                    passenger_count,
-                    trip_distance
-                FROM read_parquet('{url}');
-            """)
-            first_done = True
-        else:
-            con.execute(f"""
-                INSERT INTO {table}
-                SELECT
-                    '{cab}' AS cab_type,
-                    {vendor_col} AS vendor_id,
-                    {pu_col}   AS pickup_datetime,
-                    {do_col}   AS dropoff_datetime,
-                    passenger_count,
-                    trip_distance
-                FROM read_parquet('{url}');
-            """)
-        logger.info("Loaded %s %04d-%02d", cab.capitalize(), year, m)
-        time.sleep(RATE_LIMIT_SECONDS)
-
-    # Basic summary
-    cnt, mindt, maxdt = con.execute(
-        f"SELECT COUNT(*), MIN(pickup_datetime), MAX(pickup_datetime) FROM {table};"
-    ).fetchone()
-    print(f"{table}: {cnt} rows, {mindt} to {maxdt}")
-    logger.info("%s summary: rows=%s, min=%s, max=%s", table, cnt, mindt, maxdt)
-    return table, cnt
+    missing = [(y, m) for y in YEARS for m in MONTHS if (y, m) not in done]
+    logger.info("%s: %d months already loaded, %d to fetch", cab, len(done), len(missing))
+    failed = fetch_months(con, cab, missing, staging) if missing else []
+
+    # Basic summary per year: one SQL text for every table (the name is bound
+    # via query_table, and DuckDB quotes it as an identifier)
+    total = 0
+    lines = []
+    if failed:
+        lines.append(f"[WARN] {cab}: {len(failed)} months failed to load (rerun to retry): "
+                     + ", ".join(f"{y}-{m:02d}" for y, m in failed))
+    for year in YEARS:
+        table = f"{cab}_trips_{year}"
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({TRIP_SCHEMA});")
+        cnt, mindt, maxdt = con.execute(
+            "SELECT COUNT(*), MIN(pickup_datetime), MAX(pickup_datetime) FROM query_table(?);",
+            [table]
+        ).fetchone()
+        lines.append(f"{table}: {cnt} rows, {mindt} to {maxdt}")
+        logger.info("%s summary: rows=%s, min=%s, max=%s", table, cnt, mindt, maxdt)
+        total += cnt
+    return total, "\n".join(lines)
+
+# httpfs options are per connection, so each download cursor sets its own:
+# reuse connections and retry transient HTTP failures with exponential backoff
+# (500ms, 1s, 2s, ...)
+def configure_http(con):
+    con.execute("SET http_keep_alive=true;")
+    con.execute("SET http_retries=8;")
+    con.execute("SET http_retry_wait_ms=500;")
+    con.execute("SET http_retry_backoff=2.0;")
+
+# Run load_cab on its own cursor so cabs can load concurrently
+def load_cab_cursor(con, cab: str):
+    cur = con.cursor()
+    try:
+        configure_http(cur)
+        return load_cab(cur, cab)
+    finally:
+        cur.close()
+
+# Fetch the given (year, month) files for a cab a year at a time; returns the months that failed
+def fetch_months(con, cab: str, months: list[tuple[int, int]], staging: str):
+    """
+    Each year is its own batch and transaction, so finished years survive a
+    later failure. If a year's batch fails, its months are retried one file
+    at a time so only the broken month is left out of the ledger.
+    """
+    failed = []
+    for year in YEARS:
+        batch = [(y, m) for y, m in months if y == year]
+        if not batch:
+            continue
+        try:
+            fetch_batch(con, cab, batch, staging)
+            continue
+        except duckdb.Error as e:
+            logger.warning("%s %d: batch fetch failed (%s), retrying month by month", cab, year, e)
+        for month in batch:
+            try:
+                fetch_batch(con, cab, [month], staging)
+            except duckdb.Error as e:
+                logger.error("%s %d-%02d: fetch failed: %s", cab, month[0], month[1], e)
+                failed.append(month)
+    return failed
+
+# Fetch the given (year, month) files for a cab and append them to the per-year tables
+def fetch_batch(con, cab: str, months: list[tuple[int, int]], staging: str):
+    url_tpl, vendor_col, pu_col, do_col = cab_source(cab)
+
+    # One statement over all monthly files: DuckDB schedules their fetches in
+    # parallel (union_by_name absorbs column drift between years). Only the
+    # listed columns are fetched, and the pickup range lets the reader skip row
+    # groups by their min/max stats (also drops mis-dated trips outside YEARS).
+    # The URL list, cab and bounds are bound as parameters; only identifiers,
+    # which can't be bound, are formatted into the SQL
+    urls = [url_tpl.format(year=y, month=m) for y, m in months]
+    first, last = min(YEARS), max(YEARS)
+    con.execute(f"DROP TABLE IF EXISTS {staging};")
+    execute_throttled(con, f"""
+        CREATE TABLE {staging} AS
+        SELECT
+            ?::VARCHAR AS cab_type,
+            {vendor_col} AS vendor_id,
+            {pu_col}   AS pickup_datetime,
+            {do_col}   AS dropoff_datetime,
+            TRY_CAST(passenger_count AS UTINYINT) AS passenger_count,
+            trip_distance::FLOAT AS trip_distance,
+            EXTRACT('year' FROM {pu_col})::SMALLINT AS year,
+            filename
+        FROM read_parquet(?, union_by_name=true, filename=true, hive_partitioning=false)
+        WHERE {pu_col} >= ?::TIMESTAMP AND {pu_col} < ?::TIMESTAMP;
+    """, [cab, urls, f"{first}-01-01", f"{last + 1}-01-01"])
+    logger.info("Fetched %s: %d monthly files", cab.capitalize(), len(urls))
+
+    # Rows kept per source file, keyed by the file's (year, month)
+    counts = {}
+    for fname, cnt in con.execute(f"SELECT filename, COUNT(*) FROM {staging} GROUP BY filename;").fetchall():
+        y, m = re.search(r"(\d{4})-(\d{2})\.parquet$", fname).groups()
+        counts[(int(y), int(m))] = cnt
+
+    # Append to the per-year tables and record the months in one transaction,
+    # so the ledger never claims a month whose rows didn't land
+    con.begin()
+    try:
+        for year in YEARS:
+            table = f"{cab}_trips_{year}"
+            con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({TRIP_SCHEMA});")
+            con.execute(f"INSERT INTO {table} SELECT * EXCLUDE (year, filename) FROM {staging} WHERE year = ?;", [year])
+        con.executemany(
+            f"INSERT INTO {LEDGER} VALUES (?, ?, ?, ?, now());",
+            [[cab, y, m, counts.get((y, m), 0)] for y, m in months]
+        )
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    con.execute(f"DROP TABLE {staging};")
 
 def load_parquet_files():
     con = None
@@ -90,18 +235,20 @@ def load_parquet_files():
         con.execute("INSTALL httpfs;")
         con.execute("LOAD httpfs;")
 
-        total_yellow = 0
-        total_green = 0
+        configure_connection(con, LOAD_THREADS)
 
-        # Load all years for Yellow
-        for y in YEARS:
-            _, cnt = load_year_cab(con, y, 'yellow')
-            total_yellow += cnt
+        # Cache HTTP HEAD/metadata and Parquet footers across statements
+        con.execute("SET enable_http_metadata_cache=true;")
+        con.execute("SET parquet_metadata_cache=true;")
 
-        # Load all years for Green
-        for y in YEARS:
-            _, cnt = load_year_cab(con, y, 'green')
-            total_green += cnt
+        # Load Yellow and Green concurrently (only months not yet in the ledger)
+        ensure_ledger(con)
+        with ThreadPoolExecutor(max_workers=len(CABS)) as pool:
+            results = dict(zip(CABS, pool.map(lambda cab: load_cab_cursor(con, cab), CABS)))
+        for cab in CABS:
+            print(results[cab][1])
+        total_yellow = results['yellow'][0]
+        total_green = results['green'][0]
 
         logger.info("Finished loading all Yellow & Green tables 2015–2024")
 
@@ -0,0 +1,18 @@
+# settings.py
+# DuckDB connection settings shared by load, clean, transform and analysis
+import os
+
+# DuckDB resources (e.g. DUCKDB_MEMORY_LIMIT=16GB, DUCKDB_TEMP_DIRECTORY=/tmp/duckdb)
+DUCKDB_THREADS = os.cpu_count() or 1
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT")
+DUCKDB_TEMP_DIRECTORY = os.environ.get("DUCKDB_TEMP_DIRECTORY")
+
+
+# Set threads; memory_limit/temp_directory only override DuckDB's defaults
+# (80% of RAM, spilling next to the database file) when set
+def configure_connection(con, threads: int = DUCKDB_THREADS):
+    con.execute(f"PRAGMA threads={threads};")
+    if DUCKDB_MEMORY_LIMIT:
+        con.execute(f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}';")
+    if DUCKDB_TEMP_DIRECTORY:
+        con.execute(f"PRAGMA temp_directory='{DUCKDB_TEMP_DIRECTORY}';")
@@ -1,8 +1,12 @@
 # transform.py
 import duckdb
 import logging
+import os
 from textwrap import dedent
 
+from aggregates import bucket_aggregates_sql, largest_trip_sql
+from settings import configure_connection
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -17,6 +21,21 @@ SECONDS_PER_HOUR = 3600.0
 YEARS = range(2015, 2025)  # 2015..2024 inclusive
 CABS = ("yellow", "green")
 
+# Partitioned Parquet copy of all transformed trips (cab_type=*/year=*/*.parquet)
+# for consumers outside DuckDB; opt-in with TRANSFORM_EXPORT_PARQUET=1, since
+# analysis.py reads the summary tables and nothing in the pipeline needs it
+TRANSFORMED_PARQUET_DIR = "transformed"
+TRANSFORM_EXPORT_PARQUET = os.environ.get("TRANSFORM_EXPORT_PARQUET") == "1"
+# Rows per Parquet row group: large groups compress better, and the source is
+# already sorted by pickup time so each group's min/max stays tight
+PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+# The single physical transformed table; per-year and per-cab names are views over it
+ALL_TRANSFORMED = "all_trips_transformed_2015_2024"
+
+# TRANSFORM_PREVIEW=1 prints a few sample transformed rows
+TRANSFORM_PREVIEW = os.environ.get("TRANSFORM_PREVIEW") == "1"
+
 
 # Check if a table exists in DuckDB
 def table_exists(con, name: str) -> bool:
@@ -27,6 +46,26 @@ def table_exists(con, name: str) -> bool:
     return row is not None
 
 
+# Map every table/view name to its table_type in one catalog query
+def relation_kinds(con) -> dict:
+    return dict(con.execute("SELECT table_name, table_type FROM information_schema.tables;").fetchall())
+
+
+# Drop a table or view by name, whichever currently exists (kinds: a
+# relation_kinds() snapshot, to skip the per-name catalog lookup)
+def drop_relation(con, name: str, kinds: dict | None = None):
+    if kinds is None:
+        row = con.execute(
+            "SELECT table_type FROM information_schema.tables WHERE table_name = ?;",
+            [name]
+        ).fetchone()
+        kind = row[0] if row is not None else None
+    else:
+        kind = kinds.get(name)
+    if kind is not None:
+        con.execute(f"DROP {'VIEW' if kind == 'VIEW' else 'TABLE'} {name};")
+
+
 # Get lowercase column names from vehicle_emissions
 def get_emissions_cols(con):
     return {
@@ -37,48 +76,28 @@ def get_emissions_cols(con):
     }
 
 
-# Build CTE to fetch emissions factor
-def build_emissions_cte(con, taxi_type: str) -> str:
-    cols = get_emissions_cols(con)
+# Look up a cab's emissions factor (grams CO2 per mile) at run time
+def emissions_factor(con, taxi_type: str, cols: set) -> float:
     if "co2_grams_per_mile" not in cols:
         raise RuntimeError("vehicle_emissions must have column 'co2_grams_per_mile'.")
 
     if "taxi_type" in cols:
-        return dedent(f"""
-            ve AS (
-                SELECT co2_grams_per_mile
-                FROM vehicle_emissions
-                WHERE lower(taxi_type) = '{taxi_type}'
-                LIMIT 1
-            )
-        """).strip()
+        row = con.execute(
+            "SELECT co2_grams_per_mile FROM vehicle_emissions WHERE lower(taxi_type) = ? LIMIT 1;",
+            [taxi_type]
+        ).fetchone()
     else:
         # Single-row or default factor table
-        return dedent("""
-            ve AS (
-                SELECT co2_grams_per_mile
-                FROM vehicle_emissions
-                LIMIT 1
-            )
-        """).strip()
+        row = con.execute("SELECT co2_grams_per_mile FROM vehicle_emissions LIMIT 1;").fetchone()
+    if row is None or row[0] is None:
+        raise RuntimeError(f"No co2_grams_per_mile found in vehicle_emissions for {taxi_type}.")
+    return float(row[0])
 
 
-# Transform one cleaned table into enriched metrics
-def transform_one(con, src_clean: str, dst_transformed: str, taxi_type: str):
-    logger.info("Transforming %s -> %s (taxi_type=%s)", src_clean, dst_transformed, taxi_type)
-
-    # Ensure prerequisites
-    if not table_exists(con, "vehicle_emissions"):
-        raise RuntimeError("vehicle_emissions lookup table not found. Run load.py first.")
-    if not table_exists(con, src_clean):
-        raise RuntimeError(f"Source cleaned table not found: {src_clean}. Run clean.py first.")
-
-    con.execute(f"DROP TABLE IF EXISTS {dst_transformed};")
-
-    emissions_cte = build_emissions_cte(con, taxi_type)
-
-    # Compose the transform query
-    sql = f"""
+# Transformed SELECT over one cab's cleaned yearly tables
+def transform_select(tables: list[str], factor: float) -> str:
+    union_sql = " UNION ALL ".join(f"SELECT * FROM {t}" for t in tables)
+    return f"""
         WITH
         base AS (
             SELECT
@@ -88,10 +107,11 @@ def transform_one(con, src_clean: str, dst_transformed: str, taxi_type: str):
                 dropoff_datetime,
                 passenger_count,
                 trip_distance,
-                date_diff('second', pickup_datetime, dropoff_datetime)::DOUBLE AS duration_seconds
-            FROM {src_clean}
-        ),
-        {emissions_cte}
+                date_diff('second', pickup_datetime, dropoff_datetime)::DOUBLE AS duration_seconds,
+                -- One calendar decomposition per row, returned as a struct
+                date_part(['hour', 'dow', 'week', 'month', 'year'], pickup_datetime) AS dp
+            FROM ({union_sql})
+        )
         SELECT
             b.cab_type,
             b.vendor_id,
@@ -99,52 +119,104 @@ def transform_one(con, src_clean: str, dst_transformed: str, taxi_type: str):
             b.dropoff_datetime,
             b.passenger_count,
             b.trip_distance,
-            (b.trip_distance * ve.co2_grams_per_mile) / 1000.0 AS trip_co2_kgs,
+            -- kg to the gram as DECIMAL(9,3): stored as a 4-byte integer, summed exactly
+            ((b.trip_distance::DOUBLE * {factor!r}) / 1000.0)::DECIMAL(9,3) AS trip_co2_kgs,
             CASE
                 WHEN b.duration_seconds > 0
-                THEN b.trip_distance / (b.duration_seconds / {SECONDS_PER_HOUR})
+                THEN b.trip_distance * {SECONDS_PER_HOUR} / b.duration_seconds  -- one divide per row
                 ELSE NULL
             END AS avg_mph,
-            EXTRACT('hour' FROM b.pickup_datetime)::INTEGER  AS hour_of_day,
-            EXTRACT('dow'  FROM b.pickup_datetime)::INTEGER  AS day_of_week,  -- Sun=0 .. Sat=6
-            EXTRACT('week' FROM b.pickup_datetime)::INTEGER  AS week_of_year,
-            EXTRACT('month'FROM b.pickup_datetime)::INTEGER  AS month_of_year
+            b.dp.hour::INTEGER   AS hour_of_day,
+            b.dp.dow::INTEGER    AS day_of_week,  -- Sun=0 .. Sat=6
+            b.dp.week::INTEGER   AS week_of_year,
+            b.dp.month::INTEGER  AS month_of_year,
+            b.dp.year::SMALLINT  AS year
         FROM base b
-        CROSS JOIN ve
     """
-    con.execute(f"CREATE TABLE {dst_transformed} AS {sql};")
+
+
+# Transform every cleaned table into one physical table, written once
+def transform_all(con, worklist, dst: str = ALL_TRANSFORMED):
+    """
+    Build {dst} from all cleaned yearly tables in a single CREATE TABLE (one
+    SELECT per cab, since each has its own emissions factor), then expose the
+    per-year names as views over it. Returns the per-year view names and the
+    row count per (cab_type, year).
+    """
+    logger.info("Transforming %d cleaned tables -> %s", len(worklist), dst)
+
+    # Ensure prerequisites (one catalog snapshot serves every check and drop below)
+    kinds = relation_kinds(con)
+    if "vehicle_emissions" not in kinds:
+        raise RuntimeError("vehicle_emissions lookup table not found. Run load.py first.")
+
+    # Factors are inlined as literals so the multiply is column * constant (no join in the plan)
+    emissions_cols = get_emissions_cols(con)
+    selects = []
+    for cab in CABS:
+        tables = [src for src, _, taxi in worklist if taxi == cab]
+        if tables:
+            selects.append(transform_select(tables, emissions_factor(con, cab, emissions_cols)))
+    drop_relation(con, dst, kinds)
+    # Stored clustered by (cab_type, pickup_datetime) so row-group min/max
+    # zonemaps let the per-cab/per-year views and time filters skip data
+    con.execute(f"""
+        CREATE TABLE {dst} AS
+        SELECT * FROM ({' UNION ALL '.join(f'({s})' for s in selects)})
+        ORDER BY cab_type, pickup_datetime;
+    """)
 
     # Verify columns exist
     cols = {
         r[0].lower()
         for r in con.execute(
             "SELECT column_name FROM information_schema.columns WHERE table_name = ?;",
-            [dst_transformed]
+            [dst]
         ).fetchall()
     }
     expected = {
         "cab_type","vendor_id","pickup_datetime","dropoff_datetime",
         "passenger_count","trip_distance",
-        "trip_co2_kgs","avg_mph","hour_of_day","day_of_week","week_of_year","month_of_year"
+        "trip_co2_kgs","avg_mph","hour_of_day","day_of_week","week_of_year","month_of_year","year"
     }
     missing = expected - cols
     if missing:
-        raise RuntimeError(f"{dst_transformed} missing expected columns: {missing}")
-
-    # Print a small summary and a few sample rows
-    count = con.execute(f"SELECT COUNT(*) FROM {dst_transformed};").fetchone()[0]
-    ex = con.execute(
-        f"""
-        SELECT cab_type, trip_distance, trip_co2_kgs, avg_mph,
-               hour_of_day, day_of_week, week_of_year, month_of_year
-        FROM {dst_transformed} LIMIT 3;
-        """
-    ).fetchall()
-    print(dedent(f"""
-        [{dst_transformed}] rows: {count:,}
-        Sample rows:
-          {ex}
-    """).rstrip())
+        raise RuntimeError(f"{dst} missing expected columns: {missing}")
+
+    # Per-year views keep the old table names working without a second copy
+    created = []
+    for src, view, cab in worklist:
+        year = int(src.split("_")[2])
+        drop_relation(con, view, kinds)  # may be a table left by an older run
+        con.execute(f"""
+            CREATE VIEW {view} AS
+            SELECT * FROM {dst} WHERE cab_type = '{cab}' AND year = {year};
+        """)
+        created.append(view)
+
+    # Print a small summary (plus a few sample rows with TRANSFORM_PREVIEW=1)
+    counts = dict(
+        ((cab, year), cnt)
+        for cab, year, cnt in con.execute(
+            f"SELECT cab_type, year, COUNT(*) FROM {dst} GROUP BY ALL;"
+        ).fetchall()
+    )
+    for src, view, cab in worklist:
+        print(f"[{view}] rows: {counts.get((cab, int(src.split('_')[2])), 0):,}")
+    print(f"\n[{dst}] rows: {sum(counts.values()):,}")
+    if TRANSFORM_PREVIEW:
+        ex = con.execute(
+            f"""
+            SELECT cab_type, trip_distance, trip_co2_kgs, avg_mph,
+                   hour_of_day, day_of_week, week_of_year, month_of_year
+            FROM {dst} LIMIT 3;
+            """
+        ).fetchall()
+        print(dedent(f"""
+            Sample rows:
+              {ex}
+        """).rstrip())
+    return created, counts
 
 
 # List available cleaned tables to transform
@@ -153,11 +225,12 @@ def discover_cleaned_tables(con):
     Return a list of tuples: (src_clean, dst_transformed, taxi_type)
     for all existing cleaned tables across years/cabs.
     """
+    existing = relation_kinds(con)  # one catalog query, not one probe per name
     pairs = []
     for cab in CABS:
         for y in YEARS:
             src = f"{cab}_trips_{y}_clean"
-            if table_exists(con, src):
+            if src in existing:
                 dst = f"{cab}_trips_{y}_transformed"
                 pairs.append((src, dst, cab))
             else:
@@ -165,64 +238,114 @@ def discover_cleaned_tables(con):
     return pairs
 
 
-# Create union tables across all transformed years
-def build_unions(con, transformed_tables):
+# Create per-cab union views over the combined transformed table
+def build_unions(con, transformed_tables, counts, source: str = ALL_TRANSFORMED):
     """
-    Build three consolidated union tables across all transformed tables:
-      - yellow_trips_transformed_all
-      - green_trips_transformed_all
-      - all_trips_transformed_2015_2024
+    Expose yellow_trips_transformed_all and green_trips_transformed_all as
+    views filtering {source} (all_trips_transformed_2015_2024), which
+    transform_all already wrote as the one physical copy. Row counts come
+    from transform_all's per-(cab, year) counts rather than a rescan.
     """
-    yellow_t = [t for t in transformed_tables if t.startswith("yellow_")]
-    green_t  = [t for t in transformed_tables if t.startswith("green_")]
-
-    # Helper to create a union table
-    def make_union_table(name: str, tables: list[str]):
-        con.execute(f"DROP TABLE IF EXISTS {name};")
-        if not tables:
+    for cab in CABS:
+        name = f"{cab}_trips_transformed_all"
+        drop_relation(con, name)  # may be a table left by an older run
+        if not any(t.startswith(f"{cab}_") for t in transformed_tables):
             logger.info("No tables to union for %s", name)
-            return
-        union_sql = " UNION ALL ".join([f"SELECT * FROM {t}" for t in tables])
-        con.execute(f"CREATE TABLE {name} AS {union_sql};")
-        cnt = con.execute(f"SELECT COUNT(*) FROM {name};").fetchone()[0]
+            continue
+        con.execute(f"CREATE VIEW {name} AS SELECT * FROM {source} WHERE cab_type = '{cab}';")
+        cnt = sum(c for (c_cab, _), c in counts.items() if c_cab == cab)
         # Pre-format the count (avoid logging % ,d)
         logger.info("Created %s with %s rows", name, f"{cnt:,}")
         print(f"[UNION] {name}: {cnt:,} rows")
 
-    make_union_table("yellow_trips_transformed_all", yellow_t)
-    make_union_table("green_trips_transformed_all", green_t)
-    make_union_table("all_trips_transformed_2015_2024", yellow_t + green_t)
+
+# Cache the analysis aggregates for each per-cab union table
+def build_summaries(con):
+    """
+    Materialize {cab}_trips_summary from {cab}_trips_transformed_all: the
+    GROUPING SETS rows from aggregates.py (the same query analysis.py runs
+    live), with the largest single trip attached to the 'overall' row as
+    top_co2/top. analysis.py reads these instead of rescanning.
+    """
+    for cab in CABS:
+        src = f"{cab}_trips_transformed_all"
+        dst = f"{cab}_trips_summary"
+        con.execute(f"DROP TABLE IF EXISTS {dst};")
+        if not table_exists(con, src):
+            logger.info("No union table for %s, skipping %s", cab, dst)
+            continue
+        con.execute(f"""
+            CREATE TABLE {dst} AS
+            WITH agg AS ({bucket_aggregates_sql(src)}),
+            top AS (SELECT 'overall' AS grp, * FROM ({largest_trip_sql(src)}))
+            SELECT agg.*, top.top_co2, top.top
+            FROM agg
+            LEFT JOIN top USING (grp);
+        """)
+        logger.info("Created %s", dst)
+        print(f"[SUMMARY] {dst}")
+
+
+# Export all transformed trips to Parquet partitioned by cab and year
+def export_transformed_parquet(con, source: str = ALL_TRANSFORMED):
+    if not table_exists(con, source):
+        logger.info("No %s table, skipping Parquet export", source)
+        return
+    con.execute(f"""
+        COPY {source} TO '{TRANSFORMED_PARQUET_DIR}'
+        (FORMAT PARQUET, PARTITION_BY (cab_type, year), COMPRESSION ZSTD,
+         ROW_GROUP_SIZE {PARQUET_ROW_GROUP_SIZE}, OVERWRITE);
+    """)
+    logger.info("Exported %s to %s/", source, TRANSFORMED_PARQUET_DIR)
+    print(f"[PARQUET] {source} -> {TRANSFORMED_PARQUET_DIR}/cab_type=*/year=*/")
+
+    # Register the fresh files so analysis.py's live queries can scan them
+    for cab in CABS:
+        path = os.path.join(TRANSFORMED_PARQUET_DIR, f"cab_type={cab}")
+        if os.path.isdir(path):
+            con.execute(f"""
+                CREATE VIEW {cab}_trips_transformed_parquet AS
+                SELECT * FROM read_parquet('{path}/*/*.parquet', hive_partitioning = true);
+            """)
 
 
 # Orchestrate transforms and unions
 def main():
     try:
         con = duckdb.connect(DB_PATH, read_only=False)
+        configure_connection(con)
         logger.info("Connected to DuckDB")
 
+        # Parquet views only exist while they match this run's export
+        for cab in CABS:
+            con.execute(f"DROP VIEW IF EXISTS {cab}_trips_transformed_parquet;")
+
         # Discover all cleaned tables that actually exist
         worklist = discover_cleaned_tables(con)
         if not worklist:
             print("No cleaned tables found. Run clean.py first.")
             return
 
-        created = []
-        for src_clean, dst_transformed, taxi in worklist:
-            transform_one(con, src_clean, dst_transformed, taxi)
-            created.append(dst_transformed)
+        # One pass writes all_trips_transformed_2015_2024; yearly names become views
+        created, counts = transform_all(con, worklist)
+
+        # Build consolidated unions, then cache the aggregates analysis.py reports
+        build_unions(con, created, counts)
+        build_summaries(con)
 
-        # Build consolidated unions
-        build_unions(con, created)
+        # Optional hand-off copy for tools without DuckDB
+        if TRANSFORM_EXPORT_PARQUET:
+            export_transformed_parquet(con)
 
         # Final summary
         made = ", ".join(created)
         print("\n=== TRANSFORM COMPLETE ===")
-        print(f"Created transformed tables: {made}")
+        print(f"Created transformed views: {made}")
         if any(t.startswith("yellow_") for t in created):
             print("Created union: yellow_trips_transformed_all")
         if any(t.startswith("green_") for t in created):
             print("Created union: green_trips_transformed_all")
-        print("Created union: all_trips_transformed_2015_2024")
+        print(f"Created table: {ALL_TRANSFORMED}")
 
     except Exception as e:
         logger.exception("Transform error")